@@ -1,15 +1,10 @@
 import os
+import hashlib
 import streamlit as st
 from dotenv import load_dotenv
-import PyPDF2   # 📘 for reading PDFs
 
-# IBM TTS
-from ibm_watson import TextToSpeechV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-
-# IBM watsonx.ai
-from ibm_watsonx_ai import Credentials
-from ibm_watsonx_ai.foundation_models import Model
+# The IBM SDKs and PyMuPDF are imported where they are first used, so the page
+# renders before those heavy packages load.
 
 # ---------- Setup ----------
 load_dotenv()
@@ -32,6 +27,9 @@ st.caption("Paste or upload text/PDF → choose tone → choose voice → listen
 def get_watsonx_model():
     if not (WX_API_KEY and WX_URL and WX_PROJECT_ID):
         return None
+    from ibm_watsonx_ai import Credentials
+    from ibm_watsonx_ai.foundation_models import Model
+
     creds = Credentials(api_key=WX_API_KEY, url=WX_URL)
     return Model(
         model_id="ibm/granite-13b-instruct-v2",
@@ -48,31 +46,34 @@ def get_watsonx_model():
 def get_tts_client():
     if not (TTS_API_KEY and TTS_URL):
         return None
+    from ibm_watson import TextToSpeechV1
+    from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+
     auth = IAMAuthenticator(TTS_API_KEY)
     client = TextToSpeechV1(authenticator=auth)
     client.set_service_url(TTS_URL)
     return client
 
+REWRITE_SYSTEM = (
+    "You rewrite user text in a specified tone while keeping the original meaning. "
+    "Keep the output concise and suitable for narration. Do not add new facts."
+)
+TONE_INSTRUCTIONS = {
+    "Neutral": "Use a neutral, clear, informative tone with smooth flow.",
+    "Suspenseful": "Increase tension and anticipation; vary sentence length; end some lines with subtle hooks.",
+    "Inspiring": "Make it uplifting and motivational; use positive, energetic language and forward momentum.",
+}
+
 def rewrite_with_tone(text: str, tone: str) -> str:
     """Uses watsonx.ai to rewrite text in a chosen tone while preserving meaning."""
     model = get_watsonx_model()
     if model is None:
         return text  # fallback
 
-    system = (
-        "You rewrite user text in a specified tone while keeping the original meaning. "
-        "Keep the output concise and suitable for narration. Do not add new facts."
-    )
-    tone_instructions = {
-        "Neutral": "Use a neutral, clear, informative tone with smooth flow.",
-        "Suspenseful": "Increase tension and anticipation; vary sentence length; end some lines with subtle hooks.",
-        "Inspiring": "Make it uplifting and motivational; use positive, energetic language and forward momentum.",
-    }
-
-    prompt = f"""{system}
+    prompt = f"""{REWRITE_SYSTEM}
 
 TONE: {tone}
-TONE NOTES: {tone_instructions[tone]}
+TONE NOTES: {TONE_INSTRUCTIONS[tone]}
 
 Rewrite the following text faithfully to the meaning while adapting the tone:
 
@@ -94,13 +95,14 @@ Rewrite the following text faithfully to the meaning while adapting the tone:
 def speak_ibm_tts(text: str, voice: str = "en-US_AllisonV3Voice") -> bytes:
     """Synthesizes speech using IBM Text to Speech and returns MP3 bytes."""
     tts = get_tts_client()
-    if tts is None or not text.strip():
+    text = text.strip()
+    if tts is None or not text:
         st.error("❌ TTS client not initialized or empty text.")
         return b""
 
     try:
         res = tts.synthesize(
-            text=text.strip(),
+            text=text,
             voice=voice,
             accept="audio/mp3"
         ).get_result()
@@ -109,6 +111,22 @@ def speak_ibm_tts(text: str, voice: str = "en-US_AllisonV3Voice") -> bytes:
         st.error(f"❌ TTS error: {str(e)}")
         return b""
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def _parse_cached(key: str, _raw: bytes, kind: str) -> str:
+    """Parses an upload once per content hash (`key`); `_raw` is not hashed by Streamlit."""
+    if kind == "pdf":
+        import pymupdf  # 📘 for reading PDFs (MuPDF, ~10x faster than PyPDF2)
+
+        with pymupdf.open(stream=_raw, filetype="pdf") as doc:
+            return "".join(page.get_text() + "\n" for page in doc)
+    try:
+        return _raw.decode("utf-8")
+    except UnicodeDecodeError:
+        from charset_normalizer import from_bytes
+
+        best = from_bytes(_raw).best()  # detect the encoding instead of assuming latin-1
+        return str(best) if best is not None else _raw.decode("utf-8", errors="replace")
+
 # ---------- UI ----------
 tab1, tab2, tab3 = st.tabs(["Paste text", "Upload .txt", "Upload .pdf"])
 
@@ -120,20 +138,14 @@ with tab1:
 with tab2:
     uploaded = st.file_uploader("Upload a .txt file", type=["txt"])
     if uploaded is not None:
-        try:
-            file_text = uploaded.read().decode("utf-8")
-        except UnicodeDecodeError:
-            file_text = uploaded.read().decode("latin-1")
-        user_text = file_text
+        raw = uploaded.getvalue()  # read once; a second read() returns b""
+        user_text = _parse_cached(hashlib.md5(raw).hexdigest(), raw, "txt")
 
 with tab3:
     pdf_file = st.file_uploader("Upload a PDF file", type=["pdf"])
     if pdf_file is not None:
-        reader = PyPDF2.PdfReader(pdf_file)
-        pdf_text = ""
-        for page in reader.pages:
-            pdf_text += page.extract_text() + "\n"
-        user_text = pdf_text
+        raw = pdf_file.getvalue()
+        user_text = _parse_cached(hashlib.md5(raw).hexdigest(), raw, "pdf")
 
 tone = st.selectbox("🎚️ Choose tone", ["Neutral", "Suspenseful", "Inspiring"])
 voice = st.selectbox(
@@ -1,16 +1,21 @@
+import io
 import os
+import re
+import shutil
+import hashlib
+import tempfile
+import weakref
+import collections
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from dotenv import load_dotenv
-import PyPDF2                     # PDF reading
-from docx import Document         # DOCX reading
 
-# IBM TTS
-from ibm_watson import TextToSpeechV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-
-# IBM watsonx.ai
-from ibm_watsonx_ai import Credentials
-from ibm_watsonx_ai.foundation_models import Model
+# Heavy SDKs (ibm_watsonx_ai, ibm_watson, pymupdf, python-docx) are imported inside the
+# functions that use them, so the first page paints without loading them.
 
 
 # ---------- Setup ----------
@@ -29,18 +34,128 @@ WX_PROJECT_ID = os.getenv("WATSONX_PROJECT_ID")
 TTS_API_KEY = os.getenv("TTS_API_KEY")
 TTS_URL = os.getenv("TTS_URL", "https://api.us-south.text-to-speech.watson.cloud.ibm.com")
 
+GEN_PARAMS = {"temperature": 0.7, "decoding_method": "sample"}
+# max_new_tokens is sized per call from the input's word count, within these bounds
+MIN_NEW_TOKENS, MAX_NEW_TOKENS = 64, 1024
+REWRITE_TOKENS_PER_WORD = 1.3
+TRANSLATE_TOKENS_PER_WORD = 2.0  # non-Latin scripts split into more tokens per word
+LLM_CONCURRENCY = 2  # max watsonx calls in flight per generation
+REWRITE_MIN_CHARS = 40  # shorter inputs are narrated as-is
+NEUTRAL_PASSTHROUGH_CHARS = 200  # short text needs no "Neutral" rewrite
+LLM_CHUNK_CHARS = 1500  # paragraphs are packed into rewrite chunks of about this size
+TTS_CONCURRENCY = 6  # max TTS calls in flight per generation
+TTS_POOL_SIZE = 16  # keep-alive TTS connections shared by all sessions (requests keeps 10)
+TTS_TIMEOUT = (10, 60)  # seconds to connect, seconds to wait for audio
+POLL_INTERVAL = 0.1  # seconds between progress updates while a pipeline runs
+TTS_MAX_BYTES = 4000  # IBM TTS accepts at most 5 KB of text per request
+TTS_FIRST_BYTES = 700  # smaller first request so playback can start early
+
+# IBM TTS output as (accept, file extension, mime type). Narrations are byte-joined TTS
+# responses: MP3 frames concatenate cleanly, while Ogg/Opus becomes a chained stream that
+# some players mis-time or stop after the first link. Ogg/Opus is ~3x smaller, so it can
+# still be chosen with ECHOVERSE_AUDIO_FORMAT=ogg where the players handle chained Ogg.
+AUDIO_FORMATS = {
+    "ogg": ("audio/ogg;codecs=opus", ".ogg", "audio/ogg"),
+    "mp3": ("audio/mp3", ".mp3", "audio/mp3"),
+}
+AUDIO_ACCEPT, AUDIO_EXT, AUDIO_MIME = AUDIO_FORMATS[os.getenv("ECHOVERSE_AUDIO_FORMAT", "mp3")]
+
+CACHE_TTL = 24 * 3600  # seconds a cached rewrite/translation/narration stays valid
+AUDIO_CACHE_DIR = os.getenv("ECHOVERSE_CACHE_DIR", ".echoverse_cache")
+AUDIO_CACHE_MAX_BYTES = 256 * 1024 * 1024  # least recently used narrations are evicted past this
+# Text extracted from uploaded PDF/DOCX files is kept on disk (bounded like the audio cache),
+# so re-uploading a document in a later session or after a restart skips parsing it.
+TEXT_CACHE_DIR = os.getenv("ECHOVERSE_TEXT_CACHE_DIR", ".echoverse_text_cache")
+TEXT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+HISTORY_MAX_ITEMS = 20  # narrations kept on disk per session
+
+
+# ---------- Prompts ----------
+# Static instructions come first so every request shares the same prompt prefix,
+# which lets the serving side reuse its prefix cache.
+TONE_NOTES = {
+    "Neutral": "Use a neutral, clear, informative tone with smooth flow.",
+    "Suspenseful": "Increase tension and anticipation; vary sentence length; end some lines with subtle hooks.",
+    "Inspiring": "Make it uplifting and motivational; use positive, energetic language and forward momentum.",
+}
+
+REWRITE_TMPL = """You rewrite user text in a specified tone while keeping the original meaning. \
+Keep the output concise and suitable for narration. Do not add new facts.
+
+TONE: {tone}
+TONE NOTES: {notes}
+
+Rewrite the following text faithfully to the meaning while adapting the tone:
+
+<<<TEXT>>>
+{text}
+<<<END>>>"""
+
+TRANSLATE_TMPL = """You are a professional translator. \
+Keep the meaning faithful and suitable for audiobook narration. \
+Do not add explanations, just return the translated text.
+
+Translate the following English text into {target_lang}.
+
+<<<TEXT>>>
+{text}
+<<<END>>>"""
+
+REWRITE_TRANSLATE_TMPL = """You rewrite user text in a specified tone while keeping the original meaning, \
+then translate the result. Keep the output concise and suitable for narration. \
+Do not add new facts or explanations.
+
+TONE: {tone}
+TONE NOTES: {notes}
+
+Rewrite the following English text in the tone above, then translate the result into {target_lang}. \
+Output only the final translated text.
+
+<<<TEXT>>>
+{text}
+<<<END>>>"""
+
 
 # ---------- Helpers ----------
+@st.cache_resource(show_spinner=False)
+def get_iam_authenticator(api_key: str):
+    """One IAM token manager per API key, shared by the watsonx and TTS clients.
+
+    The token is fetched once and refreshed at ~80% of its lifetime, so neither
+    client pays its own token exchange when both use the same key.
+    """
+    from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+
+    return IAMAuthenticator(api_key)
+
+
 @st.cache_resource(show_spinner=False)
 def get_watsonx_model():
     if not (WX_API_KEY and WX_URL and WX_PROJECT_ID):
         return None
-    creds = Credentials(api_key=WX_API_KEY, url=WX_URL)
-    return Model(
+    import httpx
+    from ibm_watsonx_ai import APIClient, Credentials
+    from ibm_watsonx_ai.foundation_models import ModelInference
+
+    iam = get_iam_authenticator(WX_API_KEY)
+    creds = Credentials.from_dict({
+        "url": WX_URL,
+        "api_key": WX_API_KEY,
+        # Bearer tokens come from the shared IAM token manager instead of a second exchange
+        "token_function": lambda _http_client: iam.token_manager.get_token(),
+    })
+    # One HTTP/2 keep-alive client for every generation, so concurrent chunk calls
+    # are multiplexed over warm connections instead of paying TLS setup each time.
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16),
+        timeout=httpx.Timeout(120, connect=10),
+    )
+    client = APIClient(creds, project_id=WX_PROJECT_ID, httpx_client=http_client)
+    return ModelInference(
         model_id="ibm/granite-13b-instruct-v2",
-        params={"max_new_tokens": 300, "temperature": 0.7, "decoding_method": "sample"},
-        credentials=creds,
-        project_id=WX_PROJECT_ID,
+        params=GEN_PARAMS,
+        api_client=client,
     )
 
 
@@ -48,66 +163,208 @@ def get_watsonx_model():
 def get_tts_client():
     if not (TTS_API_KEY and TTS_URL):
         return None
-    auth = IAMAuthenticator(TTS_API_KEY)
-    client = TextToSpeechV1(authenticator=auth)
+    from ibm_watson import TextToSpeechV1
+    from ibm_cloud_sdk_core.http_adapter import SSLHTTPAdapter
+
+    client = TextToSpeechV1(authenticator=get_iam_authenticator(TTS_API_KEY))
     client.set_service_url(TTS_URL)
+    client.set_http_config({"timeout": TTS_TIMEOUT})
+    # Retry throttled (429) and 5xx synthesize calls, which concurrent chunks can trigger
+    client.enable_retries(max_retries=2, retry_interval=5.0)
+    # The client's requests.Session reuses TLS connections; size its pool so concurrent
+    # sessions don't open and discard extra sockets. Mounted last to keep the retry config.
+    client.http_adapter = SSLHTTPAdapter(
+        pool_maxsize=TTS_POOL_SIZE,
+        max_retries=client.retry_config,
+        _disable_ssl_verification=client.disable_ssl_verification,
+    )
+    client.http_client.mount("https://", client.http_adapter)
     return client
 
 
-def rewrite_with_tone(text: str, tone: str) -> str:
+def cache_key(*parts: str) -> str:
+    return hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def token_budget(text: str, tokens_per_word: float = REWRITE_TOKENS_PER_WORD) -> int:
+    """max_new_tokens for an output about as long as text, so short inputs don't decode a padded budget."""
+    return min(MAX_NEW_TOKENS, max(MIN_NEW_TOKENS, int(len(text.split()) * tokens_per_word)))
+
+
+def watsonx_generate(prompt: str, max_new_tokens: int) -> str:
+    """Runs one watsonx generation and returns the stripped text. Raises if unavailable or empty."""
     model = get_watsonx_model()
     if model is None:
-        return text  # fallback if creds missing
+        raise RuntimeError("watsonx credentials missing")
 
-    system = (
-        "You rewrite user text in a specified tone while keeping the original meaning. "
-        "Keep the output concise and suitable for narration. Do not add new facts."
-    )
-    tone_instructions = {
-        "Neutral": "Use a neutral, clear, informative tone with smooth flow.",
-        "Suspenseful": "Increase tension and anticipation; vary sentence length; end some lines with subtle hooks.",
-        "Inspiring": "Make it uplifting and motivational; use positive, energetic language and forward momentum.",
-    }
+    # Per-call params replace the model defaults, so GEN_PARAMS is passed along
+    result = model.generate_text(prompt=prompt, params={**GEN_PARAMS, "max_new_tokens": max_new_tokens})
+    if isinstance(result, dict):
+        generated = (result.get("generated_text") or "").strip()
+    else:
+        generated = (str(result) or "").strip()
+    if not generated:
+        raise ValueError("watsonx returned an empty generation")
+    return generated
 
-    prompt = f"""{system}
 
-TONE: {tone}
-TONE NOTES: {tone_instructions[tone]}
-
-Rewrite the following text faithfully to the meaning while adapting the tone:
+def skip_rewrite(text: str, tone: str) -> bool:
+    """True when a tone rewrite would be a near no-op and the LLM round-trip can be skipped."""
+    return len(text) < REWRITE_MIN_CHARS or (tone == "Neutral" and len(text) < NEUTRAL_PASSTHROUGH_CHARS)
 
-<<<TEXT>>>
-{text}
-<<<END>>>"""
 
+def rewrite_with_tone(text: str, tone: str) -> str:
+    if skip_rewrite(text, tone):
+        return text
     try:
-        result = model.generate_text(prompt=prompt)
-        if isinstance(result, dict):
-            rewritten = (result.get("generated_text") or "").strip()
-        else:
-            rewritten = (str(result) or "").strip()
-        return rewritten if rewritten else text
+        return cached_rewrite(text, tone)
     except Exception:
-        return text
+        return text  # fallback if creds missing or generation failed
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def cached_rewrite(text: str, tone: str) -> str:
+    prompt = REWRITE_TMPL.format_map({"tone": tone, "notes": TONE_NOTES[tone], "text": text})
+    return watsonx_generate(prompt, token_budget(text))
 
 
 def speak_ibm_tts(text: str, voice: str = "en-US_AllisonV3Voice") -> bytes:
-    """Synthesizes speech using IBM TTS and returns MP3 bytes."""
+    """Synthesizes speech using IBM TTS and returns AUDIO_ACCEPT-encoded bytes. Raises on failure."""
     tts = get_tts_client()
-    if tts is None or not text.strip():
-        st.error("❌ TTS client not initialized or empty text.")
-        return b""
+    text = text.strip()
+    if tts is None or not text:
+        raise RuntimeError("TTS client not initialized or empty text.")
+
+    res = tts.synthesize(
+        text=text,
+        voice=voice,
+        accept=AUDIO_ACCEPT,
+    ).get_result()
+    return res.content
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def cached_tts(text: str, voice: str) -> bytes:
+    """Audio bytes for (text, voice), served from the on-disk cache before calling IBM TTS."""
+    path = os.path.join(AUDIO_CACHE_DIR, f"{cache_key(text, voice, AUDIO_ACCEPT)}{AUDIO_EXT}")
+    audio = read_cache_file(path)
+    if audio is None:
+        audio = speak_ibm_tts(text, voice)
+        write_cache_file(path, audio, AUDIO_CACHE_MAX_BYTES)
+    return audio
+
+
+def read_cache_file(path: str) -> bytes | None:
+    """Contents of a disk cache entry, or None on a miss. Hits are marked recently used."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # keep recently used entries when pruning
+        return data
+    except OSError:
+        return None
 
+
+def write_cache_file(path: str, data: bytes, max_bytes: int):
+    """Atomically stores a disk cache entry, then prunes its directory to max_bytes."""
+    cache_dir = os.path.dirname(path)
     try:
-        res = tts.synthesize(
-            text=text.strip(),
-            voice=voice,
-            accept="audio/mp3",
-        ).get_result()
-        return res.content
-    except Exception as e:
-        st.error(f"❌ TTS error: {str(e)}")
-        return b""
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        prune_cache(cache_dir, max_bytes)
+    except OSError:
+        pass  # the disk layer is best-effort
+
+
+def prune_cache(cache_dir: str, max_bytes: int):
+    """Drops the least recently used files once cache_dir holds more than max_bytes."""
+    entries = [(e.path, e.stat()) for e in os.scandir(cache_dir)]
+    total = sum(stat.st_size for _, stat in entries)
+    if total <= max_bytes:
+        return
+    entries.sort(key=lambda entry: entry[1].st_mtime)
+    for path, stat in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= stat.st_size
+        except OSError:
+            pass
+
+
+def prewarm_clients():
+    """Builds the cached clients and fetches an IAM token off the critical path."""
+    try:
+        get_watsonx_model()
+        if get_tts_client() is not None:
+            get_iam_authenticator(TTS_API_KEY).token_manager.get_token()
+    except Exception:
+        pass  # the first generation builds them again and reports the error
+
+
+# Warm the clients while the user is still typing, once per session
+if "prewarmed" not in st.session_state:
+    st.session_state.prewarmed = True
+    prewarm = threading.Thread(target=prewarm_clients, daemon=True)
+    add_script_run_ctx(prewarm, get_script_run_ctx())
+    prewarm.start()
+
+
+# ---------- Text Extraction ----------
+# Keyed by the uploaded bytes, so widget reruns (tone/voice changes) skip re-parsing.
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def extract_txt(raw: bytes) -> str:
+    if raw.isascii():
+        return raw.decode("ascii")
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    from charset_normalizer import from_bytes
+
+    best = from_bytes(raw).best()
+    return str(best) if best is not None else raw.decode("utf-8", errors="replace")
+
+
+def disk_cached_text(kind: str, raw: bytes, parse) -> str:
+    """parse(raw), with the result kept in TEXT_CACHE_DIR under the upload's content hash."""
+    path = os.path.join(TEXT_CACHE_DIR, f"{kind}_{hashlib.md5(raw).hexdigest()}.txt")
+    cached = read_cache_file(path)
+    if cached is not None:
+        return cached.decode("utf-8")
+    text = parse(raw)
+    write_cache_file(path, text.encode("utf-8"), TEXT_CACHE_MAX_BYTES)
+    return text
+
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def extract_pdf(raw: bytes) -> str:
+    return disk_cached_text("pdf", raw, parse_pdf)
+
+
+def parse_pdf(raw: bytes) -> str:
+    import pymupdf  # PDF reading (MuPDF, native text extraction)
+
+    with pymupdf.open(stream=raw, filetype="pdf") as doc:
+        return "\n".join(page.get_text() for page in doc).strip()
+
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def extract_docx(raw: bytes) -> str:
+    return disk_cached_text("docx", raw, parse_docx)
+
+
+def parse_docx(raw: bytes) -> str:
+    from docx import Document  # DOCX reading
+    from docx.oxml.ns import qn
+
+    doc = Document(io.BytesIO(raw))
+    # Stream the body's <w:p> elements instead of building doc.paragraphs' wrapper list
+    return "\n".join(p.text for p in doc.element.body.iterchildren(qn("w:p"))).strip()
 
 
 # ---------- Input (Tabs) ----------
@@ -120,22 +377,13 @@ with tab1:
 with tab2:
     uploaded = st.file_uploader("Upload a .txt file", type=["txt"])
     if uploaded is not None:
-        raw = uploaded.read()
-        try:
-            user_text = raw.decode("utf-8")
-        except UnicodeDecodeError:
-            try:
-                user_text = raw.decode("latin-1")
-            except Exception:
-                user_text = raw.decode("utf-8", errors="ignore")
+        user_text = extract_txt(uploaded.getvalue())
 
 with tab3:
     pdf_file = st.file_uploader("Upload a PDF file", type=["pdf"])
     if pdf_file is not None:
         try:
-            reader = PyPDF2.PdfReader(pdf_file)
-            pages = [page.extract_text() or "" for page in reader.pages]
-            user_text = "\n".join(pages).strip()
+            user_text = extract_pdf(pdf_file.getvalue())
             if not user_text:
                 st.warning("⚠️ No extractable text found in this PDF (it might be scanned).")
         except Exception as e:
@@ -145,42 +393,257 @@ with tab4:
     docx_file = st.file_uploader("Upload a Word file", type=["docx"])
     if docx_file is not None:
         try:
-            doc = Document(docx_file)
-            user_text = "\n".join(p.text for p in doc.paragraphs).strip()
+            user_text = extract_docx(docx_file.getvalue())
         except Exception as e:
             st.error(f"Failed to read DOCX: {e}")
 
 
-# ---------- Options ----------
-tone = st.selectbox("🎚️ Choose tone", ["Neutral", "Suspenseful", "Inspiring"])
+# ---------- Translation Helper ----------
+# Google Translate codes for the narration languages
+TRANSLATE_CODES = {
+    "Spanish": "es",
+    "French": "fr",
+    "German": "de",
+    "Italian": "it",
+    "Portuguese (Brazil)": "pt",
+    "Japanese": "ja",
+    "Arabic": "ar",
+}
+GOOGLE_TRANSLATE_MAX_CHARS = 4500  # Google Translate rejects requests over 5000 chars
+GOOGLE_TRANSLATE_TIMEOUT = 30  # seconds; deep_translator sets no timeout on its requests
 
 
-# ---------- Translation Helper ----------
 def translate_text(text: str, target_lang: str) -> str:
-    """Translate English text into the target language using Watsonx model."""
-    model = get_watsonx_model()
-    if model is None:
-        return text  # fallback if creds missing
+    """Translate English text into the target language (Google Translate, else Watsonx model)."""
+    try:
+        return cached_translate(text, target_lang)
+    except Exception:
+        return text  # fallback if creds missing or generation failed
 
-    prompt = f"""
-    You are a professional translator. Translate the following English text into {target_lang}.
-    Keep the meaning faithful and suitable for audiobook narration. 
-    Do not add explanations, just return the translated text.
 
-    <<<TEXT>>>
-    {text}
-    <<<END>>>
-    """
+@st.cache_data(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def cached_translate(text: str, target_lang: str) -> str:
+    try:
+        return google_translate(text, target_lang)
+    except Exception:
+        pass  # deep_translator missing, unmapped language or service error
+    prompt = TRANSLATE_TMPL.format_map({"target_lang": target_lang, "text": text})
+    return watsonx_generate(prompt, token_budget(text, TRANSLATE_TOKENS_PER_WORD))
+
+
+def google_translate(text: str, target_lang: str) -> str:
+    """Plain translation needs no style transfer, so a translation API call beats an LLM generation."""
+    from deep_translator import GoogleTranslator
 
+    code = TRANSLATE_CODES[target_lang]
+
+    def translate(chunk: str) -> str:
+        # A translator keeps its request params on the instance, so chunks can't share one
+        return GoogleTranslator(source="auto", target=code).translate(chunk)
+
+    chunks = chunk_text(text, GOOGLE_TRANSLATE_MAX_CHARS) or [text]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    try:
+        # Bound the wait so a hung request falls back to watsonx instead of holding this worker
+        translated = list(pool.map(translate, chunks, timeout=GOOGLE_TRANSLATE_TIMEOUT))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    if not all(translated):
+        raise ValueError("Google Translate returned an empty translation")
+    return "\n\n".join(translated)
+
+
+def rewrite_and_translate(text: str, tone: str, target_lang: str) -> str:
+    """Tone rewrite and translation in one watsonx call, saving a round-trip per chunk."""
+    if skip_rewrite(text, tone):
+        return translate_text(text, target_lang)
     try:
-        result = model.generate_text(prompt=prompt)
-        if isinstance(result, dict):
-            translated = (result.get("generated_text") or "").strip()
-        else:
-            translated = (str(result) or "").strip()
-        return translated if translated else text
+        return cached_rewrite_translate(text, tone, target_lang)
     except Exception:
-        return text
+        return translate_text(text, target_lang)  # falls back to a plain translation
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def cached_rewrite_translate(text: str, tone: str, target_lang: str) -> str:
+    prompt = REWRITE_TRANSLATE_TMPL.format_map(
+        {"tone": tone, "notes": TONE_NOTES[tone], "target_lang": target_lang, "text": text}
+    )
+    return watsonx_generate(prompt, token_budget(text, TRANSLATE_TOKENS_PER_WORD))
+
+
+# ---------- Async Pipeline ----------
+def split_paragraphs(text: str) -> list[str]:
+    """Splits text into non-empty, blank-line separated paragraphs."""
+    return [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])")
+
+
+def split_sentences(text: str, max_bytes: int = TTS_MAX_BYTES, first_bytes: int | None = None) -> list[str]:
+    """Packs sentences greedily into chunks whose UTF-8 size stays within max_bytes.
+
+    If first_bytes is given, the first chunk is limited to it instead.
+    """
+    chunks, current = [], ""
+    limit = first_bytes or max_bytes
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        candidate = f"{current} {sentence}" if current else sentence
+        if len(candidate.encode("utf-8")) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+            limit = max_bytes
+        current = sentence
+        # A single oversized sentence is cut at the last space that fits
+        while len(current.encode("utf-8")) > limit:
+            head = current.encode("utf-8")[:limit].decode("utf-8", errors="ignore")
+            if " " in head:
+                head = head.rsplit(" ", 1)[0]
+            chunks.append(head)
+            limit = max_bytes
+            current = current[len(head):].lstrip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_text(text: str, max_chars: int = LLM_CHUNK_CHARS) -> list[str]:
+    """Packs paragraphs into chunks of at most max_chars; over-long paragraphs are split by sentence."""
+    chunks, current = [], ""
+    for paragraph in split_paragraphs(text):
+        pieces = [paragraph] if len(paragraph) <= max_chars else split_sentences(paragraph, max_chars)
+        for piece in pieces:
+            if current and len(current) + 2 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Script context of the run that submitted the current pipeline (see run_in_background)
+SCRIPT_CTX = contextvars.ContextVar("script_ctx", default=None)
+
+
+@st.cache_resource(show_spinner=False)
+def background_loop() -> asyncio.AbstractEventLoop:
+    """One event loop on a daemon thread, shared by every session's pipelines."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="echoverse-loop", daemon=True).start()
+    return loop
+
+
+def run_in_background(coro, on_poll=None):
+    """Runs `coro` on the background loop while the script thread polls for its result.
+
+    `on_poll` runs every POLL_INTERVAL; because it touches Streamlit, a stop or rerun
+    interrupts the wait, and the pipeline is then cancelled instead of running on.
+    """
+    SCRIPT_CTX.set(get_script_run_ctx())  # copied into the task's context on submit
+    fut = asyncio.run_coroutine_threadsafe(coro, background_loop())
+    try:
+        while True:
+            try:
+                return fut.result(timeout=POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if on_poll:
+                    on_poll()
+    finally:
+        fut.cancel()
+
+
+async def run_blocking(fn, *args):
+    """Runs a blocking SDK call in a worker thread that keeps the Streamlit script context."""
+    ctx = SCRIPT_CTX.get() or get_script_run_ctx()
+
+    def call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+async def arewrite(text: str, tone: str, sem: asyncio.Semaphore) -> str:
+    async with sem:
+        return await run_blocking(rewrite_with_tone, text, tone)
+
+
+async def arewrite_translate(text: str, tone: str, target_lang: str, sem: asyncio.Semaphore) -> str:
+    async with sem:
+        return await run_blocking(rewrite_and_translate, text, tone, target_lang)
+
+
+async def aspeak(text: str, voice: str, sem: asyncio.Semaphore) -> bytes:
+    async with sem:
+        return await run_blocking(cached_tts, text, voice)
+
+
+async def process_chunk(index: int, chunk: str, tone: str, target_lang: str, voice: str,
+                        llm_sem: asyncio.Semaphore, tts_sem: asyncio.Semaphore,
+                        on_first_audio=None) -> tuple[int, str, str, bytes]:
+    if target_lang.startswith("English"):
+        rewritten = translated = await arewrite(chunk, tone, llm_sem)
+    else:
+        # One fused call; the intermediate English rewrite is never produced
+        rewritten = ""
+        translated = await arewrite_translate(chunk, tone, target_lang, llm_sem)
+    first_bytes = TTS_FIRST_BYTES if on_first_audio else None
+    pieces = split_sentences(translated, first_bytes=first_bytes) or [translated]
+    speaking = [asyncio.ensure_future(aspeak(p, voice, tts_sem)) for p in pieces]
+    try:
+        if on_first_audio:
+            on_first_audio(await speaking[0])
+        audio = b"".join(await asyncio.gather(*speaking))
+    finally:
+        for task in speaking:
+            task.cancel()
+    return index, rewritten, translated, audio
+
+
+async def narrate(text: str, tone: str, target_lang: str, voice: str, audio_file,
+                  on_progress=None, on_first_audio=None) -> tuple[str, str]:
+    """Rewrites, translates and synthesizes ~LLM_CHUNK_CHARS chunks of text concurrently.
+
+    A chunk's TTS requests start as soon as its text is final, so narration of early
+    chunks overlaps LLM work on later ones. Audio chunks are written to `audio_file` in
+    input order as soon as they are contiguous (MP3 frames concatenate into one stream; Ogg
+    becomes a chained stream, see AUDIO_FORMATS), so only out-of-order chunks are held in memory.
+
+    The opening sentences are synthesized as a short first TTS request and handed to
+    `on_first_audio` as soon as they are ready, so playback can start before the rest.
+    """
+    llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+    tts_sem = asyncio.Semaphore(TTS_CONCURRENCY)
+    chunks = chunk_text(text) or [text]
+    texts = [None] * len(chunks)
+    pending = {}
+    next_index = 0
+    tasks = [asyncio.ensure_future(process_chunk(i, c, tone, target_lang, voice, llm_sem, tts_sem,
+                                                 on_first_audio=on_first_audio if i == 0 else None))
+             for i, c in enumerate(chunks)]
+    try:
+        for done, fut in enumerate(asyncio.as_completed(tasks), start=1):
+            index, rewritten, translated, audio = await fut
+            texts[index] = (rewritten, translated)
+            pending[index] = audio
+            while next_index in pending:
+                audio_file.write(pending.pop(next_index))
+                next_index += 1
+            if on_progress:
+                on_progress(done / len(chunks))
+    finally:
+        # On a stop, rerun or failed chunk, don't let the other chunks keep calling the APIs
+        for task in tasks:
+            task.cancel()
+
+    return "\n\n".join(r for r, _ in texts if r), "\n\n".join(t for _, t in texts)
 
 
 # ---------- Languages & Voices ----------
@@ -196,83 +659,165 @@ languages = {
     "Arabic": ["ar-MS_OmarVoice"]
 }
 
-lang = st.selectbox("🌍 Choose language", list(languages.keys()))
-voice = st.selectbox("🗣️ Choose voice", languages[lang], index=0)
+
+# ---------- Options ----------
+# Fragments rerun on their own widget changes, so picking a voice or browsing history
+# doesn't rerun the whole script; the Generate button still triggers a full run.
+@st.fragment
+def options_view() -> tuple[str, str, str]:
+    tone = st.selectbox("🎚️ Choose tone", list(TONE_NOTES))
+    lang = st.selectbox("🌍 Choose language", list(languages.keys()))
+    voice = st.selectbox("🗣️ Choose voice", languages[lang], index=0)
+    return tone, lang, voice
+
+
+tone, lang, voice = options_view()
 gen = st.button("✨ Rewrite, Translate & Generate Audio", type="primary", disabled=not bool(user_text.strip()))
 
 
 # ---------- History Storage ----------
 if "history" not in st.session_state:
-    st.session_state.history = []
+    st.session_state.history = collections.deque(maxlen=HISTORY_MAX_ITEMS)
 
 
-# ---------- Processing ----------
-if gen and user_text.strip():
-    with st.spinner("Rewriting with selected tone..."):
-        progress_bar = st.progress(0)
-        rewritten = rewrite_with_tone(user_text, tone)
-        progress_bar.progress(30)
+def session_audio_dir() -> str:
+    """Per-session temp directory holding the narration files referenced from history."""
+    if "audio_dir" not in st.session_state:
+        audio_dir = tempfile.mkdtemp(prefix="echoverse_")
+        # Drop the session's narrations once its history is garbage-collected (session end)
+        weakref.finalize(st.session_state.history, shutil.rmtree, audio_dir, ignore_errors=True)
+        st.session_state.audio_dir = audio_dir
+    return st.session_state.audio_dir
+
+
+def preview(text: str, limit: int = 500) -> str:
+    return text[:limit] + ("..." if len(text) > limit else "")
 
-    # Translate if non-English
-    final_text = rewritten
-    if not lang.startswith("English"):
-        with st.spinner(f"Translating into {lang}..."):
-            final_text = translate_text(rewritten, lang)
-        progress_bar.progress(60)
-    else:
-        progress_bar.progress(60)
 
-    with st.spinner("Generating narration..."):
-        audio_bytes = speak_ibm_tts(final_text, voice=voice)
-        progress_bar.progress(100)
+def file_loader(path: str):
+    """Zero-argument reader for st.download_button, so the file is read only when clicked."""
+    def load() -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+    return load
 
-    if audio_bytes:
-        st.audio(audio_bytes, format="audio/mp3")
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# ---------- Processing ----------
+if gen and user_text.strip():
+    progress_bar = st.progress(0)
+    spinner_text = "Rewriting and generating narration..."
+    if not lang.startswith("English"):
+        spinner_text = f"Rewriting, translating into {lang} and generating narration..."
+    first_audio_slot = st.empty()
+    progress = {"fraction": 0.0, "first_audio": None}  # written by the pipeline, drawn by the script thread
+    drawn = {"fraction": 0.0}
+
+    def draw_progress():
+        # Only send a delta when the bar actually moved
+        if progress["fraction"] != drawn["fraction"]:
+            drawn["fraction"] = progress["fraction"]
+            progress_bar.progress(drawn["fraction"])
+        first_audio, progress["first_audio"] = progress["first_audio"], None
+        if first_audio is not None:
+            with first_audio_slot.container():
+                st.caption("▶️ Opening lines — play them now; the full narration appears below when ready.")
+                st.audio(first_audio, format=AUDIO_MIME)
+
+    audio_path = ""
+    try:
+        with st.spinner(spinner_text):
+            with tempfile.NamedTemporaryFile(suffix=AUDIO_EXT, dir=session_audio_dir(), delete=False) as audio_file:
+                audio_path = audio_file.name
+                rewritten, final_text = run_in_background(
+                    narrate(user_text, tone, lang, voice, audio_file,
+                            on_progress=lambda fraction: progress.update(fraction=fraction),
+                            on_first_audio=lambda audio: progress.update(first_audio=audio)),
+                    on_poll=draw_progress,
+                )
+        progress_bar.progress(1.0)  # the last chunk usually lands between polls
+    except Exception as e:
+        st.error(f"❌ TTS error: {str(e)}")
+        first_audio_slot.empty()
+        remove_file(audio_path)
+        audio_path = ""
+    except BaseException:
+        remove_file(audio_path)  # the run was stopped or rerun mid-generation
+        raise
+
+    # The opening-lines player (if shown) stays, so playback that already started isn't cut off
+    if audio_path:
+        st.audio(audio_path, format=AUDIO_MIME)
         st.download_button(
-            "⬇️ Download MP3",
-            data=audio_bytes,
-            file_name="echoverse_narration.mp3",
-            mime="audio/mp3",
+            "⬇️ Download Audio",
+            data=file_loader(audio_path),
+            file_name=f"echoverse_narration{AUDIO_EXT}",
+            mime=AUDIO_MIME,
         )
 
-        # Save to history
-        st.session_state.history.append({
-            "original": user_text,
-            "rewritten": rewritten,
-            "translated": final_text,
+        # Save to history; the deque drops the oldest entry, so delete its file first
+        history = st.session_state.history
+        if len(history) == history.maxlen:
+            remove_file(history[0]["audio_path"])
+        history.append({
+            # Previews are truncated once here rather than on every rerun
+            "original_preview": preview(user_text),
+            "rewritten_preview": preview(rewritten),
+            "translated_preview": preview(final_text),
             "language": lang,
             "tone": tone,
             "voice": voice,
-            "audio": audio_bytes
+            "audio_path": audio_path
         })
 
         st.success("✅ Your Audio is Ready!")
 
 
 # ---------- Display History ----------
-if st.session_state.history:
+@st.fragment
+def history_view():
+    if not st.session_state.history:
+        return
+
     st.markdown("---")
     st.subheader("📜 History")
 
     for i, item in enumerate(reversed(st.session_state.history), start=1):
-        with st.expander(f"{i}. {item['tone']} | {item['language']} | {item['voice']}"):
+        expander = st.expander(
+            f"{i}. {item['tone']} | {item['language']} | {item['voice']}",
+            key=f"history_{item['audio_path']}",
+            on_change="rerun",
+        )
+        with expander:
             st.markdown("**Original (English)**")
-            st.markdown(item["original"][:500] + ("..." if len(item["original"]) > 500 else ""))
+            st.markdown(item["original_preview"])
 
-            st.markdown(f"**Rewritten ({item['tone']})**")
-            st.markdown(item["rewritten"][:500] + ("..." if len(item["rewritten"]) > 500 else ""))
+            if item["rewritten_preview"]:
+                st.markdown(f"**Rewritten ({item['tone']})**")
+                st.markdown(item["rewritten_preview"])
 
             if not item["language"].startswith("English"):
                 st.markdown(f"**Translated → {item['language']}**")
-                st.markdown(item["translated"][:500] + ("..." if len(item["translated"]) > 500 else ""))
-
-            st.audio(item["audio"], format="audio/mp3")
-            st.download_button(
-                f"⬇️ Download Narration {i}",
-                data=item["audio"],
-                file_name=f"echoverse_history_{i}.mp3",
-                mime="audio/mp3",
-            )
+                st.markdown(item["translated_preview"])
+
+            # Audio is only loaded for expanders the user has opened
+            if expander.open:
+                st.audio(item["audio_path"], format=AUDIO_MIME)
+                st.download_button(
+                    f"⬇️ Download Narration {i}",
+                    data=file_loader(item["audio_path"]),
+                    file_name=f"echoverse_history_{i}{AUDIO_EXT}",
+                    mime=AUDIO_MIME,
+                )
+
+
+history_view()
 
 
 # --- Footer ---